@@ -1,15 +1,16 @@
 # backend/liss_change_detector.py
-import os, json, datetime, uuid, logging
+import os, json, datetime, uuid, logging, hashlib
 from typing import Optional, Tuple, Dict, Any
+from concurrent.futures import ThreadPoolExecutor
 import numpy as np
 import rasterio
 from rasterio.mask import mask
 from rasterio.transform import xy
 import matplotlib
-matplotlib.use('Agg')
-import matplotlib.pyplot as plt
+from PIL import Image
 import joblib
 import random
+from numba import config as numba_config, njit, prange
 from sklearn.pipeline import Pipeline
 from sklearn.preprocessing import StandardScaler
 from sklearn.ensemble import RandomForestClassifier, RandomForestRegressor
@@ -21,151 +22,349 @@ logger = logging.getLogger("LISSChangeDetector")
 RND = 42
 np.random.seed(RND)
 random.seed(RND)
+# Bump whenever the model definition changes so stale pipelines on disk are retrained
+MODEL_VERSION = "v3"
+# Bump whenever _features_kernel/_band_min_max change so cached feature sidecars are rebuilt
+FEATURE_VERSION = "v1"
+# First-pass screen: well below the synthetic label thresholds (|dNDVI| > 0.15, dNDWI > 0.2, mean |dRGB| > 0.08)
+SCREEN_INDEX_THRESH = 0.05
+SCREEN_RGB_THRESH = 0.03
+# Rows per classifier call
+PREDICT_CHUNK = 1 << 20
+# Feature cache entries kept on disk (least recently used are evicted first)
+FEATURE_CACHE_MAX_ENTRIES = 4
+
+# TBB (numba's first pick when installed) hangs at interpreter exit once a parallel kernel has run
+# off the main thread, which is how FastAPI calls into the detector
+numba_config.THREADING_LAYER_PRIORITY = ["omp", "tbb", "workqueue"]
+# Subset of fastmath flags: 'nnan'/'ninf'/'reassoc'/'afn' let LLVM fold away the isfinite() guard below
+_FASTMATH = {"nsz", "arcp", "contract"}
+
+@njit(inline='always', fastmath=_FASTMATH)
+def _norm_diff(band1, band2):
+    # Normalized difference, shared by NDVI/NDWI/NBR on both dates. Inputs are min-max scaled to
+    # [0, 1], so |band1 - band2| <= band1 + band2 already bounds the ratio to [-1, 1] without a clip.
+    return (band1 - band2) / (band1 + band2 + 1e-8)
+
+@njit(parallel=True, cache=True, fastmath=_FASTMATH)
+def _features_kernel(arr_b, arr_a, mins_b, maxs_b, mins_a, maxs_a, out):
+    """Single pass over (B, H, W) before/after stacks writing the 6 change features into out (6, H, W)."""
+    H, W = arr_b.shape[1], arr_b.shape[2]
+    scale_b = np.zeros(4, dtype=np.float32)
+    scale_a = np.zeros(4, dtype=np.float32)
+    for k in range(4):
+        if maxs_b[k] - mins_b[k] > 1e-8:
+            scale_b[k] = 1.0 / (maxs_b[k] - mins_b[k])
+        if maxs_a[k] - mins_a[k] > 1e-8:
+            scale_a[k] = 1.0 / (maxs_a[k] - mins_a[k])
+    for i in prange(H):
+        for j in range(W):
+            rb = (arr_b[0, i, j] - mins_b[0]) * scale_b[0]
+            gb = (arr_b[1, i, j] - mins_b[1]) * scale_b[1]
+            bb = (arr_b[2, i, j] - mins_b[2]) * scale_b[2]
+            nb = (arr_b[3, i, j] - mins_b[3]) * scale_b[3]
+            ra = (arr_a[0, i, j] - mins_a[0]) * scale_a[0]
+            ga = (arr_a[1, i, j] - mins_a[1]) * scale_a[1]
+            ba = (arr_a[2, i, j] - mins_a[2]) * scale_a[2]
+            na = (arr_a[3, i, j] - mins_a[3]) * scale_a[3]
+
+            ndvi_b, ndvi_a = _norm_diff(nb, rb), _norm_diff(na, ra)
+            ndwi_b, ndwi_a = _norm_diff(gb, nb), _norm_diff(ga, na)
+            # Pseudo-NBR: true NBR needs SWIR (B12), which is not in the downloaded bands, so NIR/Blue stands in
+            nbr_b, nbr_a = _norm_diff(nb, bb), _norm_diff(na, ba)
+
+            out[0, i, j] = ra - rb          # dR
+            out[1, i, j] = ga - gb          # dG
+            out[2, i, j] = ba - bb          # dB
+            out[3, i, j] = ndvi_a - ndvi_b  # dNDVI
+            out[4, i, j] = ndwi_a - ndwi_b  # dNDWI
+            out[5, i, j] = nbr_b - nbr_a    # dNBR
+            for k in range(6):
+                if not np.isfinite(out[k, i, j]):
+                    out[k, i, j] = 0.0
 
 class LISSChangeDetector:
-    def __init__(self, model_dir: str = "models"):
+    def __init__(self, model_dir: str = "models", use_gpu: bool = False):
         self.model_dir = model_dir
         os.makedirs(self.model_dir, exist_ok=True)
+        # Kept beside the models, outside the StaticFiles-mounted outputs tree
+        self.feature_cache_dir = os.path.join(self.model_dir, "feature_cache")
         self.reg_pipeline = None
         self.cls_pipeline = None
+        self.cls_models_gpu = None
         self.feature_names = ["dR", "dG", "dB", "dNDVI", "dNDWI", "dNBR"]
         self._load_or_train_models()
+        if use_gpu:
+            self.cls_models_gpu = self._train_gpu_classifiers()
 
     def _load_or_train_models(self):
-        reg_path = os.path.join(self.model_dir, "reg_pipeline.joblib")
-        cls_path = os.path.join(self.model_dir, "cls_pipeline.joblib")
+        reg_path = os.path.join(self.model_dir, f"reg_pipeline_{MODEL_VERSION}.joblib")
+        cls_path = os.path.join(self.model_dir, f"cls_pipeline_{MODEL_VERSION}.joblib")
         try:
             self.reg_pipeline, self.cls_pipeline = joblib.load(reg_path), joblib.load(cls_path)
             logger.info("Loaded pipelines from disk.")
         except Exception:
             logger.info("Pipelines not found — training new synthetic models.")
             self.reg_pipeline, self.cls_pipeline = self._train_synthetic_models()
-            joblib.dump(self.reg_pipeline, reg_path)
-            joblib.dump(self.cls_pipeline, cls_path)
+            # lz4 keeps files ~5x smaller at negligible load cost; mmap_mode is not an option here since
+            # joblib ignores it for compressed files and sklearn's Tree copies node arrays on unpickle anyway
+            joblib.dump(self.reg_pipeline, reg_path, compress=('lz4', 3))
+            joblib.dump(self.cls_pipeline, cls_path, compress=('lz4', 3))
             logger.info(f"Saved synthetic models to {self.model_dir}")
 
-    def _train_synthetic_models(self):
+    def _synthetic_training_data(self):
+        rng = np.random.default_rng(RND)
         N = 2000
-        X = np.random.randn(N, len(self.feature_names)) * 0.05
+        X = rng.standard_normal((N, len(self.feature_names))) * 0.05
         # Add no-change samples
-        X_no_change = np.random.randn(N, len(self.feature_names)) * 0.01
+        X_no_change = rng.standard_normal((N, len(self.feature_names))) * 0.01
         X = np.vstack([X, X_no_change])
         
-        y_cls = np.zeros((X.shape[0], 4), dtype=int)
-        y_cls[:N, 0] = (X[:N, 3] < -0.15).astype(int)  # Deforestation
-        y_cls[:N, 1] = (X[:N, 4] > 0.2).astype(int)   # Water
-        y_cls[:N, 2] = (np.abs(X[:N, 0:3]).mean(axis=1) > 0.08).astype(int)  # Urban
-        y_cls[:N, 3] = (X[:N, 3] > 0.15).astype(int)   # Agriculture
-        
-        y_reg = np.zeros((X.shape[0], 2))
-        changed_mask = np.any(y_cls == 1, axis=1)
-        y_reg[changed_mask, 0] = np.random.uniform(500, 2000, np.sum(changed_mask))
-        y_reg[changed_mask, 1] = np.random.uniform(70, 95, np.sum(changed_mask))
+        cls_bool = np.zeros((X.shape[0], 4), dtype=bool)
+        cls_bool[:N, 0] = X[:N, 3] < -0.15  # Deforestation
+        cls_bool[:N, 1] = X[:N, 4] > 0.2   # Water
+        cls_bool[:N, 2] = np.abs(X[:N, 0:3]).mean(axis=1) > 0.08  # Urban
+        cls_bool[:N, 3] = X[:N, 3] > 0.15   # Agriculture
+        y_cls = cls_bool.astype(np.int8)
         
-        reg_pipeline = Pipeline([("scaler", StandardScaler()), ("reg", MultiOutputRegressor(RandomForestRegressor(n_estimators=100, random_state=RND)))])
-        cls_pipeline = Pipeline([("scaler", StandardScaler()), ("clf", MultiOutputClassifier(RandomForestClassifier(n_estimators=100, random_state=RND)))])
+        y_reg = np.zeros((X.shape[0], 2), dtype=np.float32)
+        changed_mask = cls_bool.any(axis=1)
+        n_changed = int(changed_mask.sum())
+        y_reg[changed_mask, 0] = rng.uniform(500, 2000, n_changed)
+        y_reg[changed_mask, 1] = rng.uniform(70, 95, n_changed)
+        return X, y_cls, y_reg
+
+    def _train_synthetic_models(self):
+        X, y_cls, y_reg = self._synthetic_training_data()
+        reg_pipeline = Pipeline([("scaler", StandardScaler()), ("reg", MultiOutputRegressor(RandomForestRegressor(n_estimators=30, max_depth=10, n_jobs=-1, random_state=RND)))])
+        cls_pipeline = Pipeline([("scaler", StandardScaler()), ("clf", MultiOutputClassifier(RandomForestClassifier(n_estimators=30, max_depth=10, n_jobs=-1, random_state=RND)))])
         
         reg_pipeline.fit(X, y_reg)
         cls_pipeline.fit(X, y_cls)
         
         return reg_pipeline, cls_pipeline
 
+    def _train_gpu_classifiers(self):
+        # cuML forests are single-output, so fit one per category on the CPU pipeline's scaled inputs
+        try:
+            import cupy as cp
+            from cuml.ensemble import RandomForestClassifier as cuRandomForestClassifier
+            if cp.cuda.runtime.getDeviceCount() == 0:
+                raise RuntimeError("no CUDA device found")
+        except Exception as e:
+            logger.warning(f"GPU inference unavailable ({e}); falling back to CPU pipelines.")
+            return None
+
+        X, y_cls, _ = self._synthetic_training_data()
+        X_gpu = cp.asarray(self.cls_pipeline.named_steps["scaler"].transform(X), dtype=cp.float32)
+        models = []
+        for k in range(y_cls.shape[1]):
+            if np.unique(y_cls[:, k]).size < 2:
+                models.append(None) # Category never occurs in the synthetic data; always "no change"
+                continue
+            clf = cuRandomForestClassifier(n_estimators=30, max_depth=10, random_state=RND)
+            clf.fit(X_gpu, cp.asarray(y_cls[:, k], dtype=cp.int32))
+            models.append(clf)
+        logger.info("Trained GPU classifiers for per-pixel inference.")
+        return models
+
+    def _predict_gpu(self, feats):
+        # Class-1 probability per category. cuML's predict() is a majority vote over trees, while the CPU
+        # forest averages probabilities, so callers threshold these at 0.5 to share the CPU decision rule.
+        import cupy as cp
+        feats_gpu = cp.asarray(self.cls_pipeline.named_steps["scaler"].transform(feats), dtype=cp.float32)
+        probs = np.zeros((feats.shape[0], len(self.cls_models_gpu)), dtype=np.float32)
+        for k, clf in enumerate(self.cls_models_gpu):
+            if clf is None:
+                continue
+            probs[:, k] = cp.asnumpy(cp.asarray(clf.predict_proba(feats_gpu))[:, 1])
+        return probs
+
     def _read_and_clip(self, path, aoi_geom=None):
-        with rasterio.open(path) as src:
+        # Let GDAL decode tiles on all cores and read straight into float32 (no extra astype copy)
+        with rasterio.Env(GDAL_NUM_THREADS='ALL_CPUS', GDAL_CACHEMAX=512), rasterio.open(path) as src:
             if aoi_geom:
                 try:
                     out_image, out_transform = mask(src, [aoi_geom], crop=True)
                     return out_image.astype(np.float32), out_transform, src.crs
                 except ValueError:
                     return np.array([]), None, None
-            return src.read().astype(np.float32), src.transform, src.crs
-
-    def _normalize_band(self, band):
-        min_val, max_val = np.nanmin(band), np.nanmax(band)
-        if max_val - min_val > 1e-8:
-            return (band - min_val) / (max_val - min_val)
-        return np.zeros_like(band)
+            return src.read(out_dtype='float32'), src.transform, src.crs
 
-    def _calc_index(self, band1, band2):
-        return np.clip((band1 - band2) / (band1 + band2 + 1e-8), -1, 1)
+    def _band_min_max(self, arr):
+        # One reduction over the whole (B, H, W) stack; the kernel applies the scaling per pixel
+        return np.nanmin(arr, axis=(1, 2)).astype(np.float32), np.nanmax(arr, axis=(1, 2)).astype(np.float32)
 
     def _build_pixel_features(self, arr_b, arr_a):
+        # The kernel indexes bands 0-3 of both stacks without bounds checks, so validate up front
+        if arr_b.ndim != 3 or arr_a.shape != arr_b.shape:
+            raise ValueError(f"Before/after stacks must have the same (B, H, W) shape, got {arr_b.shape} and {arr_a.shape}.")
         B, H, W = arr_b.shape
-        feats = np.zeros((H * W, len(self.feature_names)), dtype=np.float32)
+        if B < 4:
+            raise ValueError(f"Pixel features need at least 4 bands (R, G, B, NIR), got {B}.")
+        feats3d = np.empty((len(self.feature_names), H, W), dtype=np.float32)
         
-        bands_b = [self._normalize_band(arr_b[i]) for i in range(B)]
-        bands_a = [self._normalize_band(arr_a[i]) for i in range(B)]
+        mins_b, maxs_b = self._band_min_max(arr_b)
+        mins_a, maxs_a = self._band_min_max(arr_a)
         
-        feats[:, 0] = (bands_a[0] - bands_b[0]).flatten() # dR
-        feats[:, 1] = (bands_a[1] - bands_b[1]).flatten() # dG
-        feats[:, 2] = (bands_a[2] - bands_b[2]).flatten() # dB
-        
-        ndvi_b = self._calc_index(bands_b[3], bands_b[0])
-        ndvi_a = self._calc_index(bands_a[3], bands_a[0])
-        feats[:, 3] = (ndvi_a - ndvi_b).flatten() # dNDVI
-        
-        ndwi_b = self._calc_index(bands_b[1], bands_b[3])
-        ndwi_a = self._calc_index(bands_a[1], bands_a[3])
-        feats[:, 4] = (ndwi_a - ndwi_b).flatten() # dNDWI
+        _features_kernel(arr_b, arr_a, mins_b, maxs_b, mins_a, maxs_a, feats3d)
+        # (H*W, 6) view over the band-planar stack; the scaler in the pipeline makes its own copy anyway
+        return feats3d.reshape(len(self.feature_names), -1).T, H, W
+
+    def read_pair(self, path_b, path_a, aoi_geom=None):
+        # Independent reads; each thread opens its own dataset handle so GDAL I/O overlaps
+        with ThreadPoolExecutor(max_workers=2) as ex:
+            fb = ex.submit(self._read_and_clip, path_b, aoi_geom)
+            fa = ex.submit(self._read_and_clip, path_a, aoi_geom)
+            (arr_b, transform, crs), (arr_a, _, _) = fb.result(), fa.result()
+        return arr_b, arr_a
+
+    def _features_from_arrays(self, arr_b, arr_a):
+        if arr_b.size == 0:
+            raise RuntimeError("Selected AOI is empty or outside data bounds.")
+        return self._build_pixel_features(arr_b, arr_a)
+
+    def _feature_cache(self, path_b, path_a, aoi_geom=None):
+        cache_dir = self.feature_cache_dir
+        # Features only depend on the feature code, the two rasters and the AOI; key rasters on (mtime, size)
+        key = json.dumps({
+            "version": FEATURE_VERSION,
+            "before": [os.path.abspath(path_b), os.path.getmtime(path_b), os.path.getsize(path_b)],
+            "after": [os.path.abspath(path_a), os.path.getmtime(path_a), os.path.getsize(path_a)],
+            "aoi": aoi_geom,
+        }, sort_keys=True, default=str)
+        cache_path = os.path.join(cache_dir, hashlib.sha1(key.encode()).hexdigest() + ".npz")
+        if os.path.exists(cache_path):
+            try:
+                with np.load(cache_path) as cached:
+                    feats, H, W = cached["feats"], int(cached["H"]), int(cached["W"])
+                os.utime(cache_path) # Mark as recently used for eviction
+                logger.info(f"Loaded cached features from {cache_path}")
+                return feats, H, W
+            except Exception as e:
+                logger.warning(f"Ignoring unreadable feature cache {cache_path}: {e}")
+
+        arr_b, arr_a = self.read_pair(path_b, path_a, aoi_geom)
+        feats, H, W = self._features_from_arrays(arr_b, arr_a)
         
-        feats[:, 5] = (self._calc_index(bands_b[3], bands_b[2]) - self._calc_index(bands_a[3], bands_a[2])).flatten() # dNBR
+        # Uncompressed: float features barely deflate and a warm hit should be a plain read
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp_path = f"{cache_path}.{uuid.uuid4().hex[:8]}.tmp"
+        with open(tmp_path, "wb") as f:
+            np.savez(f, feats=feats, H=H, W=W)
+        os.replace(tmp_path, cache_path)
+        self._evict_feature_cache(cache_dir)
+        return feats, H, W
+
+    def _evict_feature_cache(self, cache_dir):
+        # Least-recently-used eviction; a full tile's entry is hundreds of MB, so keep only a few
+        try:
+            entries = sorted((os.path.join(cache_dir, f) for f in os.listdir(cache_dir) if f.endswith(".npz")),
+                             key=os.path.getmtime, reverse=True)
+        except OSError as e: # e.g. an entry removed by a concurrent request mid-listing
+            logger.warning(f"Skipping feature cache eviction: {e}")
+            return
+        for stale in entries[FEATURE_CACHE_MAX_ENTRIES:]:
+            try:
+                os.remove(stale)
+            except OSError as e:
+                logger.warning(f"Could not evict feature cache entry {stale}: {e}")
+
+    def _candidate_mask(self, feats):
+        return ((np.abs(feats[:, 3]) > SCREEN_INDEX_THRESH)
+                | (np.abs(feats[:, 4]) > SCREEN_INDEX_THRESH)
+                | (np.abs(feats[:, 0:3]).mean(axis=1) > SCREEN_RGB_THRESH))
+
+    def _change_probabilities(self, feats):
+        # Filled in place, block by block, rather than stacking a fresh (N, 4) array from per-output copies
+        probs = np.empty((feats.shape[0], 4), dtype=np.float32)
+        for start in range(0, feats.shape[0], PREDICT_CHUNK):
+            stop = start + PREDICT_CHUNK
+            # *** DEFINITIVE FIX for IndexError ***
+            pred_cls_proba = self.cls_pipeline.predict_proba(feats[start:stop])
+            # Handle the two possible shapes returned by predict_proba
+            for k, p in enumerate(pred_cls_proba):
+                if p.shape[1] == 2:
+                    probs[start:stop, k] = p[:, 1] # Probability of class '1' (change)
+                else:
+                    # If only one class is ever predicted, it returns shape (n, 1)
+                    # We assume this is prob of class '0', so prob of '1' is zero
+                    probs[start:stop, k] = 0.0
         
-        return np.nan_to_num(feats), H, W
+        return probs
 
     def _save_png(self, arr, out_path, cmap, vmin=None, vmax=None):
-        plt.figure(figsize=(arr.shape[1]/100, arr.shape[0]/100), dpi=100)
-        plt.axis('off')
-        plt.imshow(arr, cmap=cmap, vmin=vmin, vmax=vmax)
-        plt.tight_layout(pad=0)
-        plt.savefig(out_path, bbox_inches='tight', pad_inches=0, transparent=True)
-        plt.close()
+        # Colour-map straight to RGBA bytes; no figure/renderer needed for a 1:1 raster dump
+        vmin = np.nanmin(arr) if vmin is None else vmin
+        vmax = np.nanmax(arr) if vmax is None else vmax
+        normed = (arr - vmin) / (vmax - vmin) if vmax > vmin else np.zeros(arr.shape)
+        rgba = matplotlib.colormaps[cmap](normed, bytes=True)
+        Image.fromarray(rgba).save(out_path, compress_level=1)
 
     def run_on_pair(self, before_tif, after_tif, aoi_geom=None, job_id=None, out_dir="outputs"):
+        feats, H, W = self._feature_cache(before_tif, after_tif, aoi_geom)
+        return self._run_on_features(feats, H, W, job_id=job_id, out_dir=out_dir)
+
+    def run_on_arrays(self, arr_b, arr_a, job_id=None, out_dir="outputs"):
+        # For callers that already hold the rasters in memory (e.g. for previews), so nothing is read twice.
+        # Deliberately uncached: the fused kernel rebuilds features about as fast as an .npz load.
+        feats, H, W = self._features_from_arrays(arr_b, arr_a)
+        return self._run_on_features(feats, H, W, job_id=job_id, out_dir=out_dir)
+
+    def _run_on_features(self, feats, H, W, job_id=None, out_dir="outputs"):
         if not job_id: job_id = str(uuid.uuid4())[:8]
         job_out = os.path.join(out_dir, job_id)
         os.makedirs(job_out, exist_ok=True)
 
-        arr_b, transform, crs = self._read_and_clip(before_tif, aoi_geom)
-        arr_a, _, _ = self._read_and_clip(after_tif, aoi_geom)
-
-        if arr_b.size == 0:
-            raise RuntimeError("Selected AOI is empty or outside data bounds.")
-
-        feats, H, W = self._build_pixel_features(arr_b, arr_a)
+        # Only pixels passing the cheap screen are scored by the classifier; the rest stay "no change".
+        # Rows go through in blocks, which bounds the gathered/scaled copies and keeps the trees'
+        # working set hot instead of streaming the whole tile from DRAM once per tree.
+        pred_cls = np.zeros((feats.shape[0], 4), dtype=np.int8)
+        use_gpu = self.cls_models_gpu is not None
+        # On GPU the screening pass already yields probabilities; keep them so ranking needs no second round trip
+        probs_gpu = np.zeros((feats.shape[0], 4), dtype=np.float32) if use_gpu else None
+        with joblib.parallel_backend("threading", n_jobs=-1):
+            for start in range(0, feats.shape[0], PREDICT_CHUNK):
+                chunk = feats[start:start + PREDICT_CHUNK]
+                cand = self._candidate_mask(chunk)
+                if np.any(cand):
+                    if use_gpu:
+                        chunk_probs = self._predict_gpu(chunk[cand])
+                        probs_gpu[start:start + PREDICT_CHUNK][cand] = chunk_probs
+                        pred_cls[start:start + PREDICT_CHUNK][cand] = chunk_probs > 0.5
+                    else:
+                        # predict() is the 0.5 threshold on the forest's averaged probabilities, without accumulating them
+                        pred_cls[start:start + PREDICT_CHUNK][cand] = self.cls_pipeline.predict(chunk[cand])
         
-        # *** DEFINITIVE FIX for IndexError ***
-        pred_cls_proba = self.cls_pipeline.predict_proba(feats)
-        # Handle the two possible shapes returned by predict_proba
-        prob_list = []
-        for p in pred_cls_proba:
-            if p.shape[1] == 2:
-                prob_list.append(p[:, 1]) # Probability of class '1' (change)
-            else:
-                # If only one class is ever predicted, it returns shape (n, 1)
-                # We assume this is prob of class '0', so prob of '1' is zero
-                prob_list.append(np.zeros(p.shape[0]))
-        
-        pred_cls_stacked = np.stack(prob_list, axis=1)
-        
-        change_mask = np.any(pred_cls_stacked > 0.5, axis=1).reshape(H, W)
+        change_mask = np.any(pred_cls, axis=1).reshape(H, W)
         cls_map = np.zeros((H, W), dtype=np.int32)
         if np.any(change_mask):
             changed_indices = np.where(change_mask.flatten())[0]
-            highest_class = np.argmax(pred_cls_stacked[changed_indices], axis=1)
-            cls_map.flat[changed_indices] = highest_class + 1
+            # Probabilities are only needed to rank categories for the changed pixels
+            if use_gpu:
+                pred_cls_stacked = probs_gpu[changed_indices]
+            else:
+                with joblib.parallel_backend("threading", n_jobs=-1):
+                    pred_cls_stacked = self._change_probabilities(feats[changed_indices])
+            highest_class = np.empty(changed_indices.size, dtype=np.intp)
+            np.argmax(pred_cls_stacked, axis=1, out=highest_class)
+            highest_class += 1
+            cls_map.flat[changed_indices] = highest_class
 
         cls_png = os.path.join(job_out, "class_map.png")
         self._save_png(cls_map, cls_png, 'tab10', vmin=0, vmax=9)
 
         total_pixels = H * W
-        changed_pixels = int(np.sum(change_mask))
+        # One histogram pass over the class map; class 0 is "no change"
+        counts = np.bincount(cls_map.ravel(), minlength=5)
+        changed_pixels = int(counts[1:].sum())
         percent_change = round(100.0 * changed_pixels / total_pixels, 3)
         
         categories = {
-            "Deforestation": int(np.sum(cls_map == 1)),
-            "Water": int(np.sum(cls_map == 2)),
-            "Urban": int(np.sum(cls_map == 3)),
-            "Agriculture": int(np.sum(cls_map == 4))
+            "Deforestation": int(counts[1]),
+            "Water": int(counts[2]),
+            "Urban": int(counts[3]),
+            "Agriculture": int(counts[4])
         }
         
         summary = {
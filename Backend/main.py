@@ -6,7 +6,7 @@ from fastapi.staticfiles import StaticFiles
 from pydantic import BaseModel
 import numpy as np
 import rasterio
-import matplotlib.pyplot as plt
+from PIL import Image
 from liss_change_detector import LISSChangeDetector
 
 # Configure and initialize app
@@ -21,7 +21,8 @@ app.mount("/outputs", StaticFiles(directory="outputs"), name="outputs")
 
 # Load ML model
 try:
-    detector = LISSChangeDetector(model_dir="./models")
+    # USE_GPU=1 scores pixels with cuML on CUDA; the detector falls back to CPU if that is unavailable
+    detector = LISSChangeDetector(model_dir="./models", use_gpu=os.environ.get("USE_GPU") == "1")
 except Exception as e:
     detector = None
     logger.error(f"FATAL: Could not initialize LISSChangeDetector: {e}")
@@ -41,13 +42,19 @@ def save_preview(arr: np.ndarray, job_id: str, suffix: str) -> str:
         
     rgb = np.dstack([arr[0], arr[1], arr[2]]).astype(np.float32)
     
-    # Robust normalization
-    p2, p98 = np.percentile(rgb[np.isfinite(rgb)], (2, 98))
+    # Robust normalization (percentiles from a ~1e5-value strided sample instead of sorting every pixel)
+    # Stride over whole pixels so every channel is sampled regardless of the step
+    pixels = rgb.reshape(-1, 3)
+    step = max(1, pixels.size // 100_000)
+    sample = pixels[::step].reshape(-1)
+    sample = sample[np.isfinite(sample)]
+    p2, p98 = np.quantile(sample, [0.02, 0.98], method='nearest')
     rgb = np.clip(rgb, p2, p98)
     if p98 > p2:
         rgb = (rgb - p2) / (p98 - p2)
     
-    plt.imsave(path, rgb)
+    rgb = np.clip(np.nan_to_num(rgb), 0.0, 1.0)
+    Image.fromarray((rgb * 255).astype(np.uint8)).save(path, compress_level=1)
     logger.info(f"Saved preview image to {path}")
     return path
 
@@ -69,15 +76,14 @@ async def analyze_aoi(aoi: AOIBounds, request: Request):
     try:
         # DEFINITIVE FIX: We will NOT use the user's AOI for clipping.
         # We read the ENTIRE file by passing `aoi_geom=None`. This avoids all clipping errors.
-        arr_b, _, _ = detector._read_and_clip(before_tif, aoi_geom=None)
-        arr_a, _, _ = detector._read_and_clip(after_tif, aoi_geom=None)
+        arr_b, arr_a = detector.read_pair(before_tif, after_tif, aoi_geom=None)
 
         # Create previews of the full images
         before_path = save_preview(arr_b, job_id, "before")
         after_path = save_preview(arr_a, job_id, "after")
 
-        # Run analysis on the full images
-        result = detector.run_on_pair(before_tif, after_tif, aoi_geom=None, job_id=job_id)
+        # Run analysis on the same arrays instead of re-reading both files
+        result = detector.run_on_arrays(arr_b, arr_a, job_id=job_id)
         
         # Format and return the successful response
         base_url = str(request.base_url).rstrip('/')